@@ -6,18 +6,51 @@ author: Roman Janotík
 email: janotik.roman@yahoo.com
 """
 
+from __future__ import annotations
+
 import argparse
 import csv
+import math
 import re
 import sys
+import threading
 import time
-from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Tuple
 from urllib.parse import urljoin, urlparse
 
-import requests
-from bs4 import BeautifulSoup
+# requests and lxml are imported where they are used, so that `--help` and argument errors
+# do not pay for loading them.
+if TYPE_CHECKING:
+    import lxml.etree
+    import lxml.html
+    import requests
 
 BASE = "https://www.volby.cz/pls/ps2017nss/"
+META_COLUMNS = ["code", "location", "registered", "envelopes", "valid"]
+# Municipality summary in META_COLUMNS order: (code, location, registered, envelopes, valid)
+Meta = Tuple[str, str, int, int, int]
+DEFAULT_WORKERS = 8  # max. souběžně stahovaných stránek obcí
+DEFAULT_RPS = 10.0  # max. požadavků za sekundu (šetrný scraping)
+
+# Precompiled patterns for the per-cell hot paths
+_NUM_RE = re.compile(r"[^0-9-]")
+_NBSP_TRANS = str.maketrans("", "", "\xa0 \t")
+# XPath queries, compiled once on first use by _xpath()
+# List-page rows with at least two cells whose first cell is a 6-digit municipality code
+_MUNICIPALITY_ROWS = (
+    "//tr[td[2] and td[1][string-length(normalize-space())=6"
+    " and translate(normalize-space(), '0123456789', '')='']]"
+)
+_LINKS = ".//a/@href"
+_LABEL_ROW = "//tr[td[normalize-space()=$lbl]]"
+# Numbers of the summary table on a ps311 page, in column order: okrsky celkem, zpracováno,
+# v %, voliči v seznamu, vydané obálky, účast v %, odevzdané obálky, platné hlasy, % platných
+_SUMMARY_CELLS = "//table[@id='ps311_t1']//td[@class='cislo']"
+_PARTY_NAME_CELLS = "//td[@class='overflow_name']"
+_VOTES_CELL = "following-sibling::td[@class='cislo'][1]"
 
 
 # ----------------------------
@@ -32,10 +65,52 @@ def parse_int(text: str) -> int:
     """Convert strings like '1 234' or '1\xa0234' to int safely."""
     if text is None:
         return 0
-    cleaned = re.sub(r"[^0-9-]", "", text.replace("\xa0", ""))  # strip spaces & NBSP & non-digits
+    cleaned = _NUM_RE.sub("", text.translate(_NBSP_TRANS))  # strip spaces & NBSP & non-digits
     return int(cleaned) if cleaned else 0
 
 
+class RateLimiter:
+    """Thread-safe token bucket allowing on average `rate` acquisitions per second.
+
+    Up to `rate` tokens (at least one) can be spent in a burst; acquire() blocks until a token is free.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+@lru_cache(maxsize=None)
+def _xpath(expr: str) -> lxml.etree.XPath:
+    """Compiled lxml XPath for expr (tree.xpath() would compile the expression on every call)."""
+    import lxml.etree
+
+    return lxml.etree.XPath(expr)
+
+
+@lru_cache(maxsize=1024)
+def _join(base_url: str, href: str) -> str:
+    """urljoin() for detail links; absolute links are returned as they are."""
+    if href.startswith(("http://", "https://")):
+        return href
+    return urljoin(base_url, href)
+
+
 def is_valid_list_url(url: str) -> bool:
     """Basic validation: must be a ps32 list page under volby.cz for PS2017."""
     try:
@@ -51,130 +126,229 @@ def is_valid_list_url(url: str) -> bool:
 # ----------------------------
 # Scraping functions
 # ----------------------------
-def get_soup(session: requests.Session, url: str) -> BeautifulSoup:
+def make_session(cache: bool = False, rps: float = DEFAULT_RPS) -> requests.Session:
+    """Session with a connection pool large enough for concurrent downloads and retries on 5xx.
+
+    Requests that go to the network are limited to `rps` per second (0 = unlimited).
+    With cache=True responses are stored in a local SQLite file (volby_cache.sqlite) for a day,
+    so repeated runs do not hit volby.cz again – pages served from the cache skip the limiter.
+    Requires the optional requests-cache package.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    limiter = RateLimiter(rps) if rps > 0 else None
+
+    class RateLimitedAdapter(HTTPAdapter):
+        # The adapter is only reached on a cache miss, so cached pages are never throttled
+        def send(self, request, **kwargs):
+            if limiter is not None:
+                limiter.acquire()
+            return super().send(request, **kwargs)
+
+    if cache:
+        try:
+            import requests_cache
+        except ImportError:
+            die("Pro --cache je potřeba knihovna requests-cache (pip install requests-cache).")
+        session = requests_cache.CachedSession("volby_cache", backend="sqlite", expire_after=86400)
+    else:
+        session = requests.Session()
+    adapter = RateLimitedAdapter(
+        pool_connections=1,  # everything goes to www.volby.cz
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    session.headers.update({
+        "User-Agent": "Engeto Elections Scraper (https://www.volby.cz/)",
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate",  # requests decompresses transparently
+    })
+    return session
+
+
+def get_tree(session: requests.Session, url: str) -> lxml.html.HtmlElement:
+    import lxml.html
+    import requests
+
     r = session.get(url, timeout=30)
     r.raise_for_status()
-    # The site is CP1250/Windows-1250; requests usually decodes correctly. Force fallback if needed.
-    if r.encoding is None:
-        r.encoding = "cp1250"
-    return BeautifulSoup(r.text, "html.parser")
+    content_type = r.headers.get("Content-Type", "")
+    if not content_type.startswith("text/html"):
+        raise requests.RequestException(f"Neočekávaný typ obsahu '{content_type}' na {url}", response=r)
+    # The site is CP1250/Windows-1250; pass raw bytes so lxml picks the charset from <meta>.
+    return lxml.html.fromstring(r.content)
 
 
-def extract_municipality_links(soup: BeautifulSoup, base_url: str) -> List[Tuple[str, str, str]]:
+def extract_municipality_links(tree: lxml.html.HtmlElement, base_url: str) -> List[Tuple[str, str, str]]:
     """Return list of tuples (code, name, detail_url) for all municipalities on the list page."""
     rows = []
     # Heuristic: rows where first <td> looks like 6-digit code
-    for tr in soup.find_all("tr"):
-        tds = tr.find_all("td")
-        if len(tds) < 2:
-            continue
-        code_txt = tds[0].get_text(strip=True)
-        if not re.fullmatch(r"\d{6}", code_txt):
-            continue
-        name_txt = tds[1].get_text(strip=True)
+    # (non-matching rows are filtered out by the XPath, their text is never read)
+    for tr in _xpath(_MUNICIPALITY_ROWS)(tree):
+        tds = tr.findall("td")
+        code_txt, name_txt = [td.text_content().strip() for td in tds[:2]]
         # Find a link to the municipality detail (ps311) somewhere in the row
         detail_href = None
-        for a in tr.find_all("a"):
-            href = a.get("href", "")
+        for href in _xpath(_LINKS)(tr):
             if "ps311" in href:  # municipality detail page
                 detail_href = href
                 break
         if not detail_href:
             # Fallback: sometimes the code cell contains the link
-            a = tds[0].find("a")
-            if a and a.get("href"):
-                detail_href = a["href"]
+            hrefs = _xpath(_LINKS)(tds[0])
+            if hrefs and hrefs[0]:
+                detail_href = hrefs[0]
         if not detail_href:
             # As a last resort, try the last cell (column with 'X')
-            a = tds[-1].find("a")
-            if a and a.get("href"):
-                detail_href = a["href"]
+            hrefs = _xpath(_LINKS)(tds[-1])
+            if hrefs and hrefs[0]:
+                detail_href = hrefs[0]
         if not detail_href:
             # Skip if no link found (should not happen on the official list page)
             continue
-        detail_url = urljoin(base_url, detail_href)
+        detail_url = _join(base_url, detail_href)
         rows.append((code_txt, name_txt, detail_url))
     if not rows:
         die("Nepodařilo se najít žádné obce na dané stránce. Zkontroluj odkaz – musí to být ps32 stránka s výpisem obcí.")
     return rows
 
 
-def extract_value_by_label(soup: BeautifulSoup, label: str) -> int:
+def extract_value_by_label(tree: lxml.html.HtmlElement, label: str) -> int:
     """Find numbers like 'Voliči v seznamu', 'Vydané obálky', 'Platné hlasy'."""
     # exact match ignoring surrounding whitespace
-    lab = soup.find("td", string=re.compile(rf"^\s*{re.escape(label)}\s*$"))
-    if not lab:
-        return 0
-    tr = lab.find_parent("tr")
-    if not tr:
+    rows = _xpath(_LABEL_ROW)(tree, lbl=label)
+    if not rows:
         return 0
+    tds = rows[0].findall("td")
     # number is typically the last <td class='cislo'> in the same row
-    candidates = [td for td in tr.find_all("td") if "cislo" in (td.get("class") or [])]
+    candidates = [td for td in tds if td.get("class") == "cislo"]
     if not candidates:
         # fallback: any numeric-looking td in the row
-        candidates = [td for td in tr.find_all("td") if re.search(r"\d", td.get_text())]
-    return parse_int(candidates[-1].get_text()) if candidates else 0
+        candidates = [td for td in tds if any(c.isdigit() for c in td.text_content())]
+    return parse_int(candidates[-1].text_content()) if candidates else 0
+
+
+def extract_summary(tree: lxml.html.HtmlElement) -> Tuple[int, int, int]:
+    """Return (registered, envelopes, valid) from the summary table in a single query.
+
+    Falls back to looking the values up by their labels if the table is not found.
+    """
+    cells = _xpath(_SUMMARY_CELLS)(tree)
+    if len(cells) >= 8:
+        registered, envelopes, valid = (parse_int(cells[i].text_content()) for i in (3, 4, 7))
+        return registered, envelopes, valid
+    return (
+        extract_value_by_label(tree, "Voliči v seznamu"),
+        extract_value_by_label(tree, "Vydané obálky"),
+        extract_value_by_label(tree, "Platné hlasy"),
+    )
 
 
-def extract_party_votes(soup: BeautifulSoup) -> Dict[str, int]:
+def extract_party_votes(tree: lxml.html.HtmlElement) -> Dict[str, int]:
     """Collect all (party -> votes) from one municipality page.
 
-    The PS2017 site shows parties in 2 tables. We find every row that has a party name
-    in <td class='overflow_name'> and then take the first numeric cell in that row as votes.
+    The PS2017 site shows parties in 2 tables. Each row is: party number, party name
+    <td class='overflow_name'>, votes, percent – the votes are the first <td class='cislo'>
+    following the name cell.
     """
     votes: Dict[str, int] = {}
-    for tr in soup.find_all("tr"):
-        name_cell = tr.find("td", {"class": "overflow_name"})
-        if not name_cell:
-            continue
-        party = name_cell.get_text(strip=True)
-        # Find the first numeric cell in the same row
-        num = 0
-        for td in tr.find_all("td"):
-            if td is name_cell:
-                continue
-            txt = td.get_text(strip=True)
-            if re.search(r"\d", txt):
-                num = parse_int(txt)
-                # Some rows have both votes and percent. We assume the first numeric is votes.
-                break
+    for name_cell in _xpath(_PARTY_NAME_CELLS)(tree):
+        # Same ~30 names on every page – intern them so all rows share one string per party
+        party = sys.intern(name_cell.text_content().strip())
+        cells = _xpath(_VOTES_CELL)(name_cell)
+        num = parse_int(cells[0].text_content()) if cells else 0
         if party:
             votes[party] = num
     return votes
 
 
-def scrape_municipality(session: requests.Session, code: str, name: str, url: str) -> Tuple[Dict[str, int], Dict[str, int]]:
-    soup = get_soup(session, url)
-    registered = extract_value_by_label(soup, "Voliči v seznamu")
-    envelopes = extract_value_by_label(soup, "Vydané obálky")
-    valid = extract_value_by_label(soup, "Platné hlasy")
-    parties = extract_party_votes(soup)
-    meta = {
-        "code": code,
-        "location": name,
-        "registered": registered,
-        "envelopes": envelopes,
-        "valid": valid,
-    }
-    return meta, parties
-
-
-def write_csv(path: str, rows_meta: List[Dict[str, int]], rows_parties: List[Dict[str, int]]) -> None:
-    # Compute the union of all party names
-    party_names: List[str] = sorted({p for row in rows_parties for p in row.keys()})
-    header = ["code", "location", "registered", "envelopes", "valid"] + party_names
-    with open(path, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-        for meta, parties in zip(rows_meta, rows_parties):
-            line = [
-                meta["code"],
-                meta["location"],
-                meta["registered"],
-                meta["envelopes"],
-                meta["valid"],
-            ] + [parties.get(p, 0) for p in party_names]
-            writer.writerow(line)
+def scrape_municipality(session: requests.Session, code: str, name: str, url: str) -> Tuple[Meta, Dict[str, int]]:
+    tree = get_tree(session, url)
+    registered, envelopes, valid = extract_summary(tree)
+    parties = extract_party_votes(tree)
+    return (code, name, registered, envelopes, valid), parties
+
+
+def scrape_or_empty(session: requests.Session, code: str, name: str, url: str) -> Tuple[Meta, Dict[str, int]]:
+    """Like scrape_municipality, but a failed municipality yields zeros instead of an exception."""
+    try:
+        return scrape_municipality(session, code, name, url)
+    except Exception as e:
+        print(f"  -> Chyba při zpracování {name}: {e}", file=sys.stderr)
+        # Přesto pokračuj dál; doplň 0 a pokračuj
+        return (code, name, 0, 0, 0), {}
+
+
+def scrape_to_csv(
+    session: requests.Session,
+    municipalities: List[Tuple[str, str, str]],
+    path: str,
+    workers: int = DEFAULT_WORKERS,
+) -> None:
+    """Scrape all municipalities and stream their rows to CSV in the order of the list page.
+
+    Party columns are taken from the first page that returns any parties – the site lists
+    the same parties on every page of one election. Pages are downloaded by `workers` threads
+    (the request rate is capped by the session, see make_session) and each row is written
+    as soon as the header is known and all rows before it are done.
+    """
+    total = len(municipalities)
+    party_names: List[str] = []
+    # Column position of every party, so a row is filled from the parties it actually has
+    party_idx: Dict[str, int] = {}
+    writer = None
+
+    def write_row(meta: Meta, parties: Dict[str, int]) -> None:
+        cols = [0] * len(party_names)  # parties missing in a municipality stay 0
+        extra = []
+        for party, votes in parties.items():
+            i = party_idx.get(party)
+            if i is None:
+                extra.append(party)
+            else:
+                cols[i] = votes
+        if extra:
+            print(f"  -> {meta[1]}: strany mimo hlavičku CSV vynechány: {', '.join(sorted(extra))}",
+                  file=sys.stderr)
+        writer.writerow([*meta, *cols])
+
+    with ExitStack() as stack:
+        ex = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        futures = {
+            ex.submit(scrape_or_empty, session, code, name, detail_url): (i, code, name)
+            for i, (code, name, detail_url) in enumerate(municipalities)
+        }
+        # Finished rows wait here until all rows before them are written – and all of them
+        # until a page with parties has fixed the CSV header
+        pending: Dict[int, Tuple[Meta, Dict[str, int]]] = {}
+        next_i = 0
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                i, code, name = futures[future]
+                print(f"[{done}/{total}] {code} – {name}", file=sys.stderr)
+                pending[i] = future.result()
+                if writer is None:
+                    if not pending[i][1]:
+                        continue
+                    party_names = sorted(pending[i][1])
+                    party_idx = {party: j for j, party in enumerate(party_names)}
+                    f = stack.enter_context(open(path, "w", newline="", encoding="utf-8-sig", buffering=1 << 20))
+                    writer = csv.writer(f)
+                    writer.writerow(META_COLUMNS + party_names)
+                while next_i in pending:
+                    write_row(*pending.pop(next_i))
+                    next_i += 1
+        except BaseException:
+            # Ctrl+C or an error: drop the queued pages instead of downloading them all first,
+            # only the ones already in flight are finished
+            ex.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    if writer is None:
+        die("Nepodařilo se stáhnout výsledky žádné obce – CSV nebylo vytvořeno.")
 
 
 # ----------------------------
@@ -186,45 +360,36 @@ def main() -> None:
     )
     parser.add_argument("url", help="Odkaz na územní celek – stránka typu ps32... (např. https://www.volby.cz/pls/ps2017nss/ps32?xjazyk=CZ&xkraj=12&xnumnuts=7103)")
     parser.add_argument("output_csv", help="Cesta/jméno výstupního CSV souboru (např. vysledky_prostejov.csv)")
+    parser.add_argument("--cache", action="store_true", help="Ukládat stažené stránky do lokální cache (volby_cache.sqlite) na 24 h – vhodné pro opakované běhy")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Počet souběžně stahovaných stránek obcí (výchozí {DEFAULT_WORKERS})")
+    parser.add_argument("--rps", type=float, default=DEFAULT_RPS, help=f"Max. počet požadavků za sekundu, 0 = bez omezení (výchozí {DEFAULT_RPS:g})")
     args = parser.parse_args()
 
     if not is_valid_list_url(args.url):
         die("Zadej platný odkaz na stránku ps32 s výpisem obcí (jazyk CZ).")
+    if args.workers < 1:
+        die("--workers musí být alespoň 1.")
+    if not math.isfinite(args.rps) or args.rps < 0:
+        die("--rps musí být nezáporné konečné číslo.")
 
-    session = requests.Session()
-    session.headers.update({
-        "User-Agent": "Engeto Elections Scraper (https://www.volby.cz/)"
-    })
+    import requests
 
-    print("Načítám seznam obcí...", file=sys.stderr)
-    list_soup = get_soup(session, args.url)
-    municipalities = extract_municipality_links(list_soup, BASE)
-    print(f"Nalezeno obcí: {len(municipalities)}", file=sys.stderr)
+    session = make_session(cache=args.cache, rps=args.rps)
 
-    metas: List[Dict[str, int]] = []
-    parties_list: List[Dict[str, int]] = []
+    try:
+        print("Načítám seznam obcí...", file=sys.stderr)
+        list_tree = get_tree(session, args.url)
+        municipalities = extract_municipality_links(list_tree, BASE)
+        print(f"Nalezeno obcí: {len(municipalities)}", file=sys.stderr)
 
-    for i, (code, name, detail_url) in enumerate(municipalities, start=1):
-        print(f"[{i}/{len(municipalities)}] {code} – {name}", file=sys.stderr)
-        try:
-            meta, parties = scrape_municipality(session, code, name, detail_url)
-        except Exception as e:
-            print(f"  -> Chyba při zpracování {name}: {e}", file=sys.stderr)
-            # Přesto pokračuj dál; doplň 0 a pokračuj
-            meta = {"code": code, "location": name, "registered": 0, "envelopes": 0, "valid": 0}
-            parties = {}
-        metas.append(meta)
-        parties_list.append(parties)
-        time.sleep(0.2)  # šetrný scraping
-
-    write_csv(args.output_csv, metas, parties_list)
+        scrape_to_csv(session, municipalities, args.output_csv, workers=args.workers)
+    except requests.RequestException as e:
+        die(f"Síťová chyba: {e}")
     print(f"Hotovo! Výsledky uloženy do: {args.output_csv}", file=sys.stderr)
 
 
 if __name__ == "__main__":
     try:
         main()
-    except requests.RequestException as e:
-        die(f"Síťová chyba: {e}")
     except KeyboardInterrupt:
         die("Přerušeno uživatelem.", code=130)